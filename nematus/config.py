@@ -700,6 +700,31 @@ class ConfigSpecification:
                  'adding more steps allows larger minibatches to be used '
                  '(default: %(default)s)'))
 
+        group.append(ParameterSpecification(
+            name='accum_dtype', default='float32',
+            visible_arg_names=['--accum_dtype'],
+            type=str, choices=['float32', 'bfloat16', 'float16'],
+            help='data type of the gradient accumulator variables; reduced '
+                 'precision halves accumulator memory and bandwidth, and '
+                 'accumulated gradients are cast back to float32 before '
+                 'they are applied (default: %(default)s)'))
+
+        group.append(ParameterSpecification(
+            name='reduction_device', default='',
+            visible_arg_names=['--reduction_device'],
+            type=str, metavar='DEVICE',
+            help='device on which the gradients from the model replicas are '
+                 'summed and clipped (e.g. \'/cpu:0\'); by default the '
+                 'placement is left to TensorFlow'))
+
+        group.append(ParameterSpecification(
+            name='async_prefetch', default=False,
+            visible_arg_names=['--async_prefetch'],
+            action='store_true',
+            help='prepare the feed values for the next sub-batch on a '
+                 'background thread while the current sub-batch is running, '
+                 'overlapping host-side preparation with computation'))
+
         group.append(ParameterSpecification(
             name='maxibatch_size', default=20,
             visible_arg_names=['--maxibatch_size'],
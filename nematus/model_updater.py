@@ -1,5 +1,6 @@
 import sys
 import math
+import threading
 
 import numpy
 import tensorflow as tf
@@ -115,26 +116,80 @@ class ModelUpdater(object):
             y = numpy.array(y)
             y_mask = numpy.array(y_mask)
 
-        if (self._config.max_sentences_per_device != 0
-            or self._config.max_tokens_per_device != 0):
+        # Compute the per-sentence lengths once; the splitters and
+        # _split_and_pad_minibatch all work from these vectors rather than
+        # re-summing the masks.
+        source_lengths = numpy.sum(x_mask, axis=0)
+        target_lengths = numpy.sum(y_mask, axis=0)
+
+        # Token-limited minibatches (other than MRT ones, whose candidate
+        # groups must stay contiguous) are packed into sub-batches with a
+        # best-fit decreasing heuristic, which reorders the sentences
+        # itself; see _pack_minibatch_for_device_size.
+        use_packing = (self._config.max_tokens_per_device != 0
+                       and index is None)
+
+        # Otherwise, sort the sentences by length before splitting, so that
+        # each sub-batch contains sentences of similar length and the number
+        # of padding tokens fed to the model is reduced. The loss and
+        # gradients are weighted sums over sentences, so the permutation
+        # doesn't change the result. MRT minibatches are left alone because
+        # groups of candidate translations must stay contiguous. Minibatches
+        # produced with sorting enabled (the default) are usually already
+        # sorted, in which case the arrays are left untouched.
+        if (self._config.sort_by_length
+                and self._config.loss_function != 'MRT'
+                and not use_packing):
+            combined = source_lengths + target_lengths
+            if numpy.any(combined[1:] < combined[:-1]):
+                order = numpy.argsort(combined, kind='stable')
+                x = x[..., order]
+                x_mask = x_mask[:, order]
+                y = y[:, order]
+                y_mask = y_mask[:, order]
+                source_lengths = source_lengths[order]
+                target_lengths = target_lengths[order]
+
+        if use_packing:
+            order, start_points = self._pack_minibatch_for_device_size(
+                source_lengths, target_lengths,
+                self._config.max_tokens_per_device)
+            x = x[..., order]
+            x_mask = x_mask[:, order]
+            y = y[:, order]
+            y_mask = y_mask[:, order]
+            source_lengths = source_lengths[order]
+            target_lengths = target_lengths[order]
+        elif (self._config.max_sentences_per_device != 0
+              or self._config.max_tokens_per_device != 0):
             start_points = self._split_minibatch_for_device_size(
-                x_mask, y_mask, self._config.max_sentences_per_device,
+                source_lengths, target_lengths,
+                self._config.max_sentences_per_device,
                 self._config.max_tokens_per_device, index)
         else:
             n = len(self._replicas) * self._config.gradient_aggregation_steps
-            start_points = self._split_minibatch_into_n(x_mask, y_mask, n)
+            start_points = self._split_minibatch_into_n(source_lengths,
+                                                        target_lengths, n)
 
         if self._config.loss_function == 'MRT':
             split_x, split_x_mask, split_y, split_y_mask, split_score, weights, split_index = \
-                self._split_and_pad_minibatch_mrt(x, x_mask, y, y_mask, score, start_points, index)
+                self._split_and_pad_minibatch_mrt(x, x_mask, y, y_mask, score,
+                                                  source_lengths,
+                                                  target_lengths, start_points,
+                                                  index)
         else:
             split_x, split_x_mask, split_y, split_y_mask, weights = \
-                self._split_and_pad_minibatch(x, x_mask, y, y_mask, start_points)
+                self._split_and_pad_minibatch(x, x_mask, y, y_mask,
+                                              source_lengths, target_lengths,
+                                              start_points)
 
         # Normalize the weights so that _ModelUpdateGraph can just sum the
         # weighted gradients from each sub-batch (without needing a
-        # subsequent division step).
-        normalized_weights = [w / sum(weights) for w in weights]
+        # subsequent division step). The normalization spans all sub-batches
+        # of the minibatch, not just the ones in a single accumulation step,
+        # so it has to happen here rather than in-graph.
+        weights = numpy.asarray(weights, dtype=numpy.float32)
+        normalized_weights = weights / weights.sum()
 
         # Scale the weights so that short minibatches (e.g. at the end of
         # maxibatches) contribute less.
@@ -145,62 +200,91 @@ class ModelUpdater(object):
             # Actual batch size / Max batch size, in tokens
             scaling_factor = (x_mask.shape[0] * x_mask.shape[1]) / self._config.token_batch_size
 
-        # Accumulate gradients.
-        # the list to store the per-token-probability if required
-        print_pro = []
-        for i in range(0, len(split_x), len(self._replicas)):
+        def make_feed_dict(i):
+            # The sub-batch arrays are views that are non-contiguous along
+            # the batch axis; feeding them as-is would make the TF runtime
+            # repack them internally on every run. Packing them here instead
+            # costs the same copy at most once per sub-batch (already
+            # contiguous arrays are passed through untouched) and, with
+            # --async_prefetch, moves it off the critical path.
             feed_dict = {}
             feed_dict[self._graph.scaling_factor] = scaling_factor
+            feed_dict[self._graph.replica_weights] \
+                = normalized_weights[i:i + len(self._replicas)]
             for j in range(len(self._replicas)):
-                feed_dict[self._graph.replica_weights[j]] \
-                    = normalized_weights[i + j]
-                feed_dict[self._replicas[j].inputs.x] = split_x[i + j]
-                feed_dict[self._replicas[j].inputs.x_mask] = split_x_mask[i + j]
-                feed_dict[self._replicas[j].inputs.y] = split_y[i + j]
-                feed_dict[self._replicas[j].inputs.y_mask] = split_y_mask[i + j]
+                feed_dict[self._replicas[j].inputs.x] = \
+                    numpy.ascontiguousarray(split_x[i + j])
+                feed_dict[self._replicas[j].inputs.x_mask] = \
+                    numpy.ascontiguousarray(split_x_mask[i + j])
+                feed_dict[self._replicas[j].inputs.y] = \
+                    numpy.ascontiguousarray(split_y[i + j])
+                feed_dict[self._replicas[j].inputs.y_mask] = \
+                    numpy.ascontiguousarray(split_y_mask[i + j])
                 if self._config.loss_function == 'MRT':
                     # convert evaluation score of each candidates into tensor for subsequent expected risk calculations
                     feed_dict[self._replicas[j].inputs.scores] = split_score[i + j]
                     # also convey information of starting point of each source sentences to later calculation
                     feed_dict[self._replicas[j].inputs.index] = split_index[i + j]
                 feed_dict[self._replicas[j].inputs.training] = True
+            return feed_dict
+
+        # Optionally, prepare the feed values for the next accumulation step
+        # on a background thread while the current step is running. NumPy and
+        # session.run() both release the GIL, so the two genuinely overlap.
+        worker = (_PrefetchWorker(make_feed_dict)
+                  if self._config.async_prefetch else None)
+
+        # Accumulate gradients.
+        # the list to store the per-token-probability if required
+        print_pro = []
+        feed_dict = make_feed_dict(0)
+        for i in range(0, len(split_x), len(self._replicas)):
+            next_i = i + len(self._replicas)
+            if worker is not None and next_i < len(split_x):
+                worker.start(next_i)
 
             if self._config.print_per_token_pro == False:
                 session.run([self._graph.accum_ops], feed_dict=feed_dict)
             else:
                 tmp = session.run([self._graph.accum_ops], feed_dict=feed_dict)
-                for i in range(len(tmp[0])):
-                    print_pro.append(tmp[0][i].tolist())
+                for k in range(len(tmp[0])):
+                    print_pro.append(tmp[0][k].tolist())
+
+            if next_i < len(split_x):
+                feed_dict = (worker.join() if worker is not None
+                             else make_feed_dict(next_i))
 
         if self._config.print_per_token_pro == False:
-            # Apply the gradients (and optionally write the summary).
+            # Apply the gradients (and optionally write the summary). The
+            # accumulated mean loss is scaled by the batch size in-graph, and
+            # the accumulated values are reset to zero in the same run (after
+            # they have been read).
+            apply_feed_dict = {self._graph.batch_size: x.shape[-1]}
             if not write_summary:
                 fetches = self._graph.apply_ops
-                global_step, apply_grads, mean_loss_per_sent = session.run(fetches)
+                global_step, apply_grads, sum_loss, _ = \
+                    session.run(fetches, feed_dict=apply_feed_dict)
             else:
                 assert self._summary_writer is not None
                 fetches = self._graph.apply_ops + self._graph.summary_ops
-                global_step, apply_grads, mean_loss_per_sent, merged_summary = \
-                    session.run(fetches)
+                global_step, apply_grads, sum_loss, _, merged_summary = \
+                    session.run(fetches, feed_dict=apply_feed_dict)
                 self._summary_writer.add_summary(merged_summary, global_step)
 
-            # Reset accumulated values to zero ready for the next call.
-            session.run(self._graph.reset_ops)
-
             # Return the sum of the individual sentence losses.
-            return mean_loss_per_sent * x.shape[-1]
+            return sum_loss
         else:
             return print_pro
 
-    def _split_minibatch_into_n(self, x_mask, y_mask, n):
+    def _split_minibatch_into_n(self, source_lengths, target_lengths, n):
         """Determines how to split a minibatch into n equal-sized sub-batches.
 
         The sub-batch size is (approximately) the minibatch size divided by n,
         where size is defined as the number of source + target tokens.
 
         Args:
-            x_mask: Numpy array with shape (seq_len, batch_size)
-            y_mask: Numpy array with shape (seq_len, batch_size)
+            source_lengths: Numpy array with shape (batch_size,)
+            target_lengths: Numpy array with shape (batch_size,)
             n: int
 
         Returns:
@@ -208,8 +292,6 @@ class ModelUpdater(object):
             sub-batch.
         """
 
-        source_lengths = numpy.sum(x_mask, axis=0)
-        target_lengths = numpy.sum(y_mask, axis=0)
         assert len(source_lengths) == len(target_lengths)
         num_sents = len(source_lengths)
 
@@ -222,27 +304,29 @@ class ModelUpdater(object):
         start_points = [0]
         while True:
             i = start_points[-1]
-            s_longest = source_lengths[i]
-            t_longest = target_lengths[i]
-            next_start_point = None
-            for j in range(i+1, num_sents):
-                s_longest = max(s_longest, source_lengths[j])
-                t_longest = max(t_longest, target_lengths[j])
-                s_tokens = s_longest * (j-i+1)
-                t_tokens = t_longest * (j-i+1)
-                if s_tokens + t_tokens > soft_limit:
-                    # Allow the sub-batch to be over-filled, but only by one
-                    # sentence worth of tokens.
-                    next_start_point = j + 1
-                    break
-            if next_start_point is None or next_start_point >= num_sents:
+            # The size of the sub-batch covering sentences i..j is the
+            # running maximum length times the number of sentences (i.e. the
+            # padded size). Both factors are non-decreasing in j, so the
+            # sizes form a sorted array and the first over-full position can
+            # be located with a binary search.
+            run_s = numpy.maximum.accumulate(source_lengths[i:])
+            run_t = numpy.maximum.accumulate(target_lengths[i:])
+            k = numpy.arange(1, num_sents-i+1)
+            sizes = (run_s + run_t) * k
+            j_rel = int(numpy.searchsorted(sizes, soft_limit, side='right'))
+            # Allow the sub-batch to be over-filled, but only by one
+            # sentence worth of tokens (and never split before the second
+            # sentence).
+            j_rel = max(j_rel, 1)
+            next_start_point = i + j_rel + 1
+            if j_rel >= num_sents-i or next_start_point >= num_sents:
                 break
             start_points.append(next_start_point)
 
         assert len(start_points) <= n
         return start_points
 
-    def _split_minibatch_for_device_size(self, x_mask, y_mask,
+    def _split_minibatch_for_device_size(self, source_lengths, target_lengths,
                                          max_sents_per_device=0,
                                          max_tokens_per_device=0, index=None):
         """Determines how to split a minibatch into device-sized sub-batches.
@@ -250,8 +334,8 @@ class ModelUpdater(object):
         Either max_sents_per_device or max_tokens_per_device must be given.
 
         Args:
-            x_mask: Numpy array with shape (seq_len, batch_size)
-            y_mask: Numpy array with shape (seq_len, batch_size)
+            source_lengths: Numpy array with shape (batch_size,)
+            target_lengths: Numpy array with shape (batch_size,)
             max_sents_per_device: int
             max_tokens_per_device: int
 
@@ -262,70 +346,134 @@ class ModelUpdater(object):
 
         assert max_sents_per_device == 0 or max_tokens_per_device == 0
         assert not (max_sents_per_device == 0 and max_tokens_per_device == 0)
-        if index is not None:
-            s_index = dict(zip(index[0], list(range(len(index[0])))))
 
-        source_lengths = numpy.sum(x_mask, axis=0)
-        target_lengths = numpy.sum(y_mask, axis=0)
         assert len(source_lengths) == len(target_lengths)
         num_sents = len(source_lengths)
 
+        # The sentence-based split depends only on the number of sentences,
+        # so it can return before any of the token-based set-up below.
+        if max_sents_per_device != 0:
+            return list(range(0, num_sents, max_sents_per_device))
+
         # Determine where to split the minibatch to produce sub-batches that
         # fit the device capacity.
-        if max_sents_per_device != 0:
-            start_points = list(range(0, num_sents, max_sents_per_device))
+        start_points = [0]
+        if index is None:
+            while True:
+                i = start_points[-1]
+                # As in _split_minibatch_into_n, the padded sub-batch
+                # sizes are non-decreasing in j, so the first sentence
+                # that doesn't fit can be found with a binary search.
+                run_s = numpy.maximum.accumulate(source_lengths[i:])
+                run_t = numpy.maximum.accumulate(target_lengths[i:])
+                k = numpy.arange(1, num_sents-i+1)
+                j_rel = int(min(
+                    numpy.searchsorted(run_s*k, max_tokens_per_device,
+                                       side='right'),
+                    numpy.searchsorted(run_t*k, max_tokens_per_device,
+                                       side='right')))
+                # Each sub-batch contains at least one sentence, even if
+                # that sentence alone exceeds the token limit.
+                j_rel = max(j_rel, 1)
+                if j_rel >= num_sents-i:
+                    break
+                start_points.append(i + j_rel)
         else:
-            start_points = [0]
-            if index is None:
-                while True:
-                    i = start_points[-1]
-                    s_longest = source_lengths[i]
-                    t_longest = target_lengths[i]
-                    next_start_point = None
-                    for j in range(i+1, num_sents):
-                        s_longest = max(s_longest, source_lengths[j])
-                        t_longest = max(t_longest, target_lengths[j])
-                        s_tokens = s_longest * (j-i+1)
-                        t_tokens = t_longest * (j-i+1)
-                        if (s_tokens > max_tokens_per_device
-                            or t_tokens > max_tokens_per_device):
-                            next_start_point = j
-                            break
-                    if next_start_point is None:
-                        break
-                    start_points.append(next_start_point)
-            else:
-                # split the dataset based on index points which indicates the index of each group of candidate
-                # translations of MRT
-                while True:
-                    i = start_points[-1]
-                    s_longest = source_lengths[i]
-                    t_longest = target_lengths[i]
-                    next_start_point = None
-                    for j in range(i + 1, num_sents):
-                        s_longest = max(s_longest, source_lengths[j])
-                        t_longest = max(t_longest, target_lengths[j])
-                        s_tokens = s_longest * (j - i + 1)
-                        t_tokens = t_longest * (j - i + 1)
-                        if (s_tokens > max_tokens_per_device
-                                or t_tokens > max_tokens_per_device):
-                            if j in s_index:
-                                next_start_point = j
-                                break
-                            else:
-                                while True:
-                                    j -= 1
-                                    if j in s_index:
-                                        break
-                                next_start_point = j
-                                break
-                    if next_start_point is None:
-                        break
-                    start_points.append(next_start_point)
+            # split the dataset based on index points which indicates the index of each group of candidate
+            # translations of MRT
+            s_index = dict(zip(index[0], list(range(len(index[0])))))
+            while True:
+                i = start_points[-1]
+                run_s = numpy.maximum.accumulate(source_lengths[i:])
+                run_t = numpy.maximum.accumulate(target_lengths[i:])
+                k = numpy.arange(1, num_sents-i+1)
+                j_rel = int(min(
+                    numpy.searchsorted(run_s*k, max_tokens_per_device,
+                                       side='right'),
+                    numpy.searchsorted(run_t*k, max_tokens_per_device,
+                                       side='right')))
+                j_rel = max(j_rel, 1)
+                if j_rel >= num_sents-i:
+                    break
+                # Move the split backwards to the nearest index point so
+                # that a group of candidate translations is never split
+                # across sub-batches.
+                j = i + j_rel
+                while j not in s_index:
+                    j -= 1
+                start_points.append(j)
 
         return start_points
 
-    def _split_and_pad_minibatch(self, x, x_mask, y, y_mask, start_points):
+    def _pack_minibatch_for_device_size(self, source_lengths, target_lengths,
+                                        max_tokens_per_device):
+        """Packs a minibatch into device-sized sub-batches.
+
+        Unlike _split_minibatch_for_device_size, which splits the minibatch
+        in input order, this assigns sentences to sub-batches with a
+        best-fit decreasing heuristic: sentences are taken in order of
+        decreasing size and each is placed into the fullest sub-batch that
+        still has room for it. This typically produces fewer, fuller
+        sub-batches, and so fewer padding tokens, than the greedy split.
+
+        Since the assignment reorders the sentences, the minibatch arrays
+        must be permuted to match before they are split.
+
+        Args:
+            source_lengths: Numpy array with shape (batch_size,)
+            target_lengths: Numpy array with shape (batch_size,)
+            max_tokens_per_device: int
+
+        Returns:
+            A pair. The first element is a Numpy array of sentence indices
+            to be applied to the batch axis of the minibatch arrays. The
+            second is a list of indices representing the starting points of
+            each sub-batch in the permuted minibatch.
+        """
+
+        # Take the sentences in order of decreasing size, so that a
+        # sub-batch's maximum lengths are fixed by its first sentence and
+        # later (shorter) sentences just fill the remaining capacity.
+        order = numpy.argsort(source_lengths + target_lengths,
+                              kind='stable')[::-1]
+
+        # Each bin is a triple: [sentence indices, max source length,
+        # max target length].
+        bins = []
+        for idx in order:
+            s = source_lengths[idx]
+            t = target_lengths[idx]
+            best = None
+            best_slack = None
+            for b in bins:
+                size = len(b[0]) + 1
+                s_tokens = max(b[1], s) * size
+                t_tokens = max(b[2], t) * size
+                if (s_tokens <= max_tokens_per_device
+                        and t_tokens <= max_tokens_per_device):
+                    slack = max_tokens_per_device - max(s_tokens, t_tokens)
+                    if best is None or slack < best_slack:
+                        best = b
+                        best_slack = slack
+            if best is None:
+                # Open a new bin. A bin containing a single sentence is
+                # allowed to exceed the limit, as in
+                # _split_minibatch_for_device_size.
+                bins.append([[idx], s, t])
+            else:
+                best[0].append(idx)
+                best[1] = max(best[1], s)
+                best[2] = max(best[2], t)
+
+        packed_order = []
+        start_points = []
+        for indices, _, _ in bins:
+            start_points.append(len(packed_order))
+            packed_order.extend(indices)
+        return numpy.asarray(packed_order), start_points
+
+    def _split_and_pad_minibatch(self, x, x_mask, y, y_mask, source_lengths,
+                                 target_lengths, start_points):
         """Splits a minibatch according to a list of split points.
 
         Args:
@@ -333,6 +481,8 @@ class ModelUpdater(object):
             x_mask: Numpy array with shape (seq_len, batch_size)
             y: Numpy array with shape (seq_len, batch_size)
             y_mask: Numpy array with shape (seq_len, batch_size)
+            source_lengths: Numpy array with shape (batch_size,)
+            target_lengths: Numpy array with shape (batch_size,)
             start_points: list of zero-based indices
 
         Returns:
@@ -360,11 +510,16 @@ class ModelUpdater(object):
         def trim_arrays(arrays, new_seq_lens):
             return [a[..., 0:l, :] for a, l in zip(arrays, new_seq_lens)]
 
-        max_lens = [int(numpy.max(numpy.sum(m, axis=0))) for m in split_x_mask]
+        # The per-sub-batch maximum lengths are computed with a single fused
+        # reduction over the length vectors rather than one reduction per
+        # sub-batch slice.
+        boundaries = numpy.asarray(start_points)
+
+        max_lens = numpy.maximum.reduceat(source_lengths, boundaries).astype(int)
         split_x = trim_arrays(split_x, max_lens)
         split_x_mask = trim_arrays(split_x_mask, max_lens)
 
-        max_lens = [int(numpy.max(numpy.sum(m, axis=0))) for m in split_y_mask]
+        max_lens = numpy.maximum.reduceat(target_lengths, boundaries).astype(int)
         split_y = trim_arrays(split_y, max_lens)
         split_y_mask = trim_arrays(split_y_mask, max_lens)
 
@@ -373,33 +528,38 @@ class ModelUpdater(object):
         # (up to and including the <EOS> tokens) not the capacity of the
         # sub-batch.
         # TODO: loss is calculated according to target side, hence here should be weighted by target tokens only.
-        weights = [numpy.sum(t)
-                   for t in split_y_mask]
+        weights = list(numpy.add.reduceat(target_lengths, boundaries))
 
         # Pad the split lists with dummy arrays so that the total number of
-        # sub-batches is a multiple of the number of replicas.
+        # sub-batches is a multiple of the number of replicas. Usually the
+        # splitter already produces a multiple, and no padding is needed.
 
         remainder = len(start_points) % len(self._replicas)
         padding_size = 0 if remainder == 0 else len(self._replicas) - remainder
 
-        def pad(split_a, padding_size):
-            assert len(split_a) > 0
-            dummy_array = split_a[0][..., -1:]
+        if padding_size > 0:
+            # The dummy sub-batches have a weight of zero, so their content
+            # is irrelevant; single-token arrays keep the wasted copy and
+            # compute as small as possible. The masks are ones (not zeros)
+            # so that the per-replica loss stays finite - a NaN would
+            # survive multiplication by the zero weight.
+            dummy_x = numpy.zeros((x.shape[0], 1, 1), dtype=x.dtype)
+            dummy_x_mask = numpy.ones((1, 1), dtype=x_mask.dtype)
+            dummy_y = numpy.zeros((1, 1), dtype=y.dtype)
+            dummy_y_mask = numpy.ones((1, 1), dtype=y_mask.dtype)
             for i in range(padding_size):
-                split_a.append(dummy_array)
-
-        pad(split_x, padding_size)
-        pad(split_x_mask, padding_size)
-        pad(split_y, padding_size)
-        pad(split_y_mask, padding_size)
-
-        for i in range(padding_size):
-            weights.append(0.0)
+                split_x.append(dummy_x)
+                split_x_mask.append(dummy_x_mask)
+                split_y.append(dummy_y)
+                split_y_mask.append(dummy_y_mask)
+                weights.append(0.0)
 
         return split_x, split_x_mask, split_y, split_y_mask, weights
 
 
-    def _split_and_pad_minibatch_mrt(self, x, x_mask, y, y_mask, score, start_points, index):
+    def _split_and_pad_minibatch_mrt(self, x, x_mask, y, y_mask, score,
+                                     source_lengths, target_lengths,
+                                     start_points, index):
         """Splits a minibatch according to a list of split points (function basically same as _split_and_pad_minibatch),
         only difference is that the evaluation score of each sentence would also be split accordingly.
 
@@ -409,6 +569,8 @@ class ModelUpdater(object):
             y: Numpy array with shape (seq_len, batch_size)
             y_mask: Numpy array with shape (seq_len, batch_size)
             score: Numpy array with shape (batch_size)
+            source_lengths: Numpy array with shape (batch_size,)
+            target_lengths: Numpy array with shape (batch_size,)
             start_points: list of zero-based indices
 
         Returns:
@@ -450,11 +612,15 @@ class ModelUpdater(object):
         def trim_arrays(arrays, new_seq_lens):
             return [a[..., 0:l, :] for a, l in zip(arrays, new_seq_lens)]
 
-        max_lens = [int(numpy.max(numpy.sum(m, axis=0))) for m in split_x_mask]
+        # As in _split_and_pad_minibatch, use fused reductions over the
+        # length vectors instead of one reduction per sub-batch slice.
+        boundaries = numpy.asarray(start_points)
+
+        max_lens = numpy.maximum.reduceat(source_lengths, boundaries).astype(int)
         split_x = trim_arrays(split_x, max_lens)
         split_x_mask = trim_arrays(split_x_mask, max_lens)
 
-        max_lens = [int(numpy.max(numpy.sum(m, axis=0))) for m in split_y_mask]
+        max_lens = numpy.maximum.reduceat(target_lengths, boundaries).astype(int)
         split_y = trim_arrays(split_y, max_lens)
         split_y_mask = trim_arrays(split_y_mask, max_lens)
 
@@ -467,23 +633,68 @@ class ModelUpdater(object):
         remainder = len(start_points) % len(self._replicas)
         padding_size = 0 if remainder == 0 else len(self._replicas) - remainder
 
-        def pad(split_a, padding_size):
-            assert len(split_a) > 0
-            dummy_array = split_a[0][..., -1:]
+        if padding_size > 0:
+            # Unlike _split_and_pad_minibatch, slice a real sub-batch for
+            # the dummies: the split index arrays must refer to actual
+            # candidate groups.
+            def pad(split_a, padding_size):
+                assert len(split_a) > 0
+                dummy_array = split_a[0][..., -1:]
+                for i in range(padding_size):
+                    split_a.append(dummy_array)
+
+            pad(split_x, padding_size)
+            pad(split_x_mask, padding_size)
+            pad(split_y, padding_size)
+            pad(split_y_mask, padding_size)
+            pad(tmp, padding_size)
+
             for i in range(padding_size):
-                split_a.append(dummy_array)
+                weights.append(0.0)
+                split_score.append(0.0)
 
-        pad(split_x, padding_size)
-        pad(split_x_mask, padding_size)
-        pad(split_y, padding_size)
-        pad(split_y_mask, padding_size)
-        pad(tmp, padding_size)
+        return split_x, split_x_mask, split_y, split_y_mask, split_score, weights, tmp
 
-        for i in range(padding_size):
-            weights.append(0.0)
-            split_score.append(0.0)
 
-        return split_x, split_x_mask, split_y, split_y_mask, split_score, weights, tmp
+class _PrefetchWorker(object):
+    """Runs a preparation function on a background thread.
+
+    ModelUpdater uses this to build the feed values for the next sub-batch
+    while session.run() is processing the current one. Since both NumPy and
+    TensorFlow release the GIL, preparation and computation overlap rather
+    than running serially.
+
+    At most one preparation can be in flight at a time: each call to start()
+    must be followed by a call to join() before the next start().
+    """
+
+    def __init__(self, prepare_func):
+        """Sets the function to be run by start().
+
+        Args:
+            prepare_func: the function to run on the background thread.
+        """
+        self._prepare_func = prepare_func
+        self._thread = None
+        self._result = None
+
+    def start(self, *args):
+        """Starts preparing on a background thread."""
+        assert self._thread is None
+        self._thread = threading.Thread(target=self._run, args=args)
+        self._thread.start()
+
+    def join(self):
+        """Waits for the background thread and returns the prepared value."""
+        assert self._thread is not None
+        self._thread.join()
+        self._thread = None
+        result = self._result
+        self._result = None
+        return result
+
+    def _run(self, *args):
+        self._result = self._prepare_func(*args)
 
 
 class _ModelUpdateGraph(object):
@@ -492,19 +703,21 @@ class _ModelUpdateGraph(object):
     def __init__(self, config, num_gpus, replicas, optimizer, global_step):
         """Constructs the graph nodes used by ModelUpdater.
 
-        The graph has a placeholder input for each replica weight (the weight
-        should be the normalized weight of the sub-batch being run by that
-        replica). The placeholders are exposed to ModelUpdater via the
-        self.replica_weights property.
+        The graph has a vector placeholder input for the replica weights
+        (each entry should be the normalized weight of the sub-batch being
+        run by the corresponding replica). The placeholder is exposed to
+        ModelUpdater via the self.replica_weights property.
 
         At various points, ModelUpdater.update() will run different parts of
-        the graph depending on whether it is accumulating, applying, or
-        resetting the gradients. Operations for each are exposed to
-        ModelUpdater via the following properties:
+        the graph depending on whether it is accumulating or applying the
+        gradients. Operations for each are exposed to ModelUpdater via the
+        following properties:
 
             self.accum_ops
             self.apply_ops
-            self.reset_ops
+
+        Applying the gradients also resets the accumulated values to zero
+        (after they have been read), so a single session.run covers both.
 
         The self.summary_ops property is provided for summary writing.
 
@@ -525,12 +738,17 @@ class _ModelUpdateGraph(object):
         self._scaling_factor = tf.compat.v1.placeholder(name='scaling_factor',
                                               shape=(), dtype=tf.float32)
 
-        # Create the placeholders for the replica weights.
-        self._replica_weights = []
-        for i in range(len(self._replicas)):
-            name = 'replica_weight_{}'.format(i)
-            placeholder = tf.compat.v1.placeholder(name=name, shape=(), dtype=tf.float32)
-            self._replica_weights.append(placeholder)
+        # Create the placeholder for the minibatch size (in sentences). It
+        # is used to scale the accumulated mean loss in-graph, so that
+        # apply_ops directly yields the summed sentence loss.
+        self._batch_size = tf.compat.v1.placeholder(name='batch_size',
+                                                    shape=(), dtype=tf.int32)
+
+        # Create the placeholder for the replica weights: a single vector
+        # with one (normalized) weight per replica.
+        self._replica_weights = tf.compat.v1.placeholder(
+            name='replica_weights', shape=(len(self._replicas),),
+            dtype=tf.float32)
 
         # Define the (non-trainable) variables for accumulating gradients and
         # losses. These need to be variables because their values must be
@@ -542,24 +760,49 @@ class _ModelUpdateGraph(object):
             initializer=tf.zeros_initializer(),
             trainable=False)
 
-        self._trainables, self._accumulated_gradients = {}, {}
-        for i, v in enumerate(tf.compat.v1.trainable_variables()):
-            self._trainables[v.name] = v
-            g = tf.compat.v1.get_variable(
-                name='accum'+str(i),  # FIXME better name. Variable scope?
-                initializer=tf.zeros_like(v),
-                trainable=False)
-            self._accumulated_gradients[v.name] = g
+        accum_dtype = {'float32': tf.float32,
+                       'bfloat16': tf.bfloat16,
+                       'float16': tf.float16}[config.accum_dtype]
+
+        # The accumulators are kept in a list that is positionally aligned
+        # with the trainable variables (compute_gradients returns gradients
+        # in trainable-variable order, so everything can be zipped).
+        self._trainables = tf.compat.v1.trainable_variables()
+        self._accumulated_gradients = []
+        for i, v in enumerate(self._trainables):
+            # Only float32 variables get a reduced-precision accumulator;
+            # variables that are already low-precision keep their own dtype.
+            if v.dtype.base_dtype == tf.float32:
+                dtype = accum_dtype
+            else:
+                dtype = v.dtype.base_dtype
+            # Place each accumulator on the same device as its variable, so
+            # that accumulating and applying gradients never has to copy
+            # across devices (the update ops follow their variable).
+            with tf.compat.v1.colocate_with(v):
+                g = tf.compat.v1.get_variable(
+                    name='accum'+str(i),  # FIXME better name. Variable scope?
+                    initializer=tf.zeros(v.shape, dtype=dtype),
+                    trainable=False)
+            self._accumulated_gradients.append(g)
+
+        # The regularization terms depend only on the model variables, not
+        # on the inputs, so they are built once here and shared by all
+        # replicas rather than rebuilt inside every replica's graph.
+        self._regularization_term = self._define_regularization_term()
 
         self._define_accum_ops()
         self._define_apply_ops()
-        self._define_reset_ops()
         self._define_summary_ops()
 
     @property
     def scaling_factor(self):
         return self._scaling_factor
 
+    @property
+    def batch_size(self):
+        return self._batch_size
+
     @property
     def replica_weights(self):
         return self._replica_weights
@@ -572,20 +815,10 @@ class _ModelUpdateGraph(object):
     def apply_ops(self):
         return self._apply_ops
 
-    @property
-    def reset_ops(self):
-        return self._reset_ops
-
     @property
     def summary_ops(self):
         return self._summary_ops
 
-    def _define_reset_ops(self):
-        """Defines a set of ops to reset the accumulated values to zero."""
-        self._reset_ops = [v.assign(tf.zeros_like(v))
-                           for v in [self._accumulated_loss] +
-                                    list(self._accumulated_gradients.values())]
-
     def _define_accum_ops(self):
         """Defines the graph nodes used for a single accumulation step."""
 
@@ -616,40 +849,61 @@ class _ModelUpdateGraph(object):
                     else:
                         assert False
                     if self._config.print_per_token_pro == False:
-                        loss = self._regularize(loss, self._config.decay_c,
-                                                self._config.map_decay_c)
+                        loss = self._regularize(loss)
                         grad_vars = self._optimizer.compute_gradients(loss)
                         all_grad_vars.append(grad_vars)
                         weight = self._replica_weights[i]
                         weighted_losses.append(loss*weight)
 
         if self._config.print_per_token_pro == False:
-            summed_loss = sum(weighted_losses)
+            # add_n sums the replica losses in one op, rather than the chain
+            # of adds that Python's sum() would build.
+            summed_loss = tf.add_n(weighted_losses)
 
             summed_grad_vars = self._sum_gradients(all_grad_vars,
                                                self._replica_weights)
 
-            self._accum_ops = [tf.compat.v1.assign_add(self._accumulated_loss, summed_loss)]
-
-            self._accum_ops += [tf.compat.v1.assign_add(self._accumulated_gradients[v.name],
-                                          g * self._scaling_factor)
-                            for g, v in summed_grad_vars]
+            # tf.cast is a no-op for the (default) case where the
+            # accumulators are float32 like the gradients.
+            accum_grad_ops = []
+            for accum, (g, v) in zip(self._accumulated_gradients,
+                                     summed_grad_vars):
+                accum_grad_ops.append(tf.compat.v1.assign_add(
+                    accum, tf.cast(g * self._scaling_factor,
+                                   accum.dtype.base_dtype)))
+
+            # Group the per-variable updates into a single op so that the
+            # runtime schedules (and the client fetches) one op per step
+            # rather than one per variable.
+            self._accum_ops = [
+                tf.compat.v1.assign_add(self._accumulated_loss, summed_loss),
+                tf.group(*accum_grad_ops)]
         else:
             self._accum_ops = print_pro
 
     def _define_apply_ops(self):
-        """Defines the graph nodes for applying the accumulated gradients."""
+        """Defines the graph nodes for applying the accumulated gradients.
 
-        final_loss = self._accumulated_loss
+        The apply step also resets the accumulated values to zero once they
+        have been read, so that ModelUpdater doesn't need a separate
+        session.run per minibatch just to do the reset.
+        """
 
-        final_grad_vars = [(self._accumulated_gradients[key],
-                            self._trainables[key])
-                           for key in self._trainables.keys()]
+        # Snapshot the accumulated loss so that it is read before the reset
+        # ops (which have a control dependency on this read) zero it.
+        final_loss = tf.identity(self._accumulated_loss)
+
+        final_grad_vars = [(tf.cast(accum, v.dtype.base_dtype), v)
+                           for accum, v in zip(self._accumulated_gradients,
+                                               self._trainables)]
 
         if self._config.clip_c > 0.0:
             grads, varss = list(zip(*final_grad_vars))
-            clipped_grads, global_norm = tf.clip_by_global_norm(
-                grads, clip_norm=self._config.clip_c)
+            # Place the global-norm computation on the reduction device (if
+            # one was configured), like the gradient sums.
+            with tf.compat.v1.device(self._config.reduction_device or None):
+                clipped_grads, global_norm = tf.clip_by_global_norm(
+                    grads, clip_norm=self._config.clip_c)
             # Might be interesting to see how the global norm changes over
             # time, attach a summary?
             final_grad_vars = list(zip(clipped_grads, varss))
@@ -658,37 +912,63 @@ class _ModelUpdateGraph(object):
             final_grad_vars,
             global_step=self._global_step)
 
-        self._apply_ops = [self._global_step, apply_grads, final_loss]
+        # Scale the accumulated mean loss by the minibatch size so that the
+        # fetched value is already the sum of the individual sentence losses.
+        sum_loss = final_loss * tf.cast(self._batch_size, tf.float32)
+
+        # Reset the accumulated values to zero, but only after the gradients
+        # have been applied and the loss has been read.
+        with tf.control_dependencies([apply_grads, final_loss]):
+            reset_ops = [v.assign(tf.zeros_like(v))
+                         for v in [self._accumulated_loss] +
+                                  self._accumulated_gradients]
+            reset = tf.group(*reset_ops)
+
+        self._apply_ops = [self._global_step, apply_grads, sum_loss, reset]
+
+        # Keep a pre-reset read of the loss for the summary ops, which may be
+        # fetched in the same run as the reset.
+        self._final_loss = final_loss
 
     def _define_summary_ops(self):
         """Defines the summary ops."""
-        tf.compat.v1.summary.scalar(name='mean_cost', tensor=self._accumulated_loss)
+        # Use the pre-reset read of the accumulated loss: the summary may be
+        # evaluated in the same session.run as the reset ops.
+        tf.compat.v1.summary.scalar(name='mean_cost', tensor=self._final_loss)
         tf.compat.v1.summary.scalar(name='t', tensor=self._global_step)
         self._summary_ops = [tf.compat.v1.summary.merge_all()]
 
-    def _regularize(self, loss, decay_c, map_decay_c):
-        """Optionally, adds L2 and MAP-L2 regularization terms to the loss."""
+    def _define_regularization_term(self):
+        """Builds the L2 / MAP-L2 regularization term, or None if unused."""
+        decay_c = self._config.decay_c
+        map_decay_c = self._config.map_decay_c
+        if decay_c <= 0.0 and map_decay_c <= 0.0:
+            return None
+        term = tf.constant(0.0, dtype=tf.float32)
         with tf.compat.v1.variable_scope("loss"):
             # Optionally, add an L2 loss term.
             if decay_c > 0.0:
                 l2_sum = tf.add_n([tf.nn.l2_loss(v)
-                                   for v in tf.compat.v1.trainable_variables()])
-                l2_loss = l2_sum * tf.constant(decay_c, dtype=tf.float32)
-                loss += l2_loss
+                                   for v in self._trainables])
+                term += l2_sum * tf.constant(decay_c, dtype=tf.float32)
             # Optionally, add an L2 loss term based on a prior model.
             if map_decay_c > 0.0:
-                map_l2_loss = tf.constant(0.0, dtype=tf.float32)
                 map_l2_acc = []
-                for v in tf.compat.v1.trainable_variables():
+                for v in self._trainables:
                     prior_name = 'prior/'+v.name.split(':')[0]
                     prior_v = tf.compat.v1.get_variable(
                         prior_name, initializer=v.initialized_value(),
                         trainable=False, collections=['prior_variables'],
                         dtype=v.initialized_value().dtype)
                     map_l2_acc.append(tf.nn.l2_loss(v - prior_v))
-                map_l2_loss = (tf.add_n(map_l2_acc)
-                               * tf.constant(map_decay_c, dtype=tf.float32))
-                loss += map_l2_loss
+                term += (tf.add_n(map_l2_acc)
+                         * tf.constant(map_decay_c, dtype=tf.float32))
+        return term
+
+    def _regularize(self, loss):
+        """Optionally, adds the shared regularization term to the loss."""
+        if self._regularization_term is not None:
+            loss += self._regularization_term
         return loss
 
     def _sum_gradients(self, all_grad_vars, weights):
@@ -704,35 +984,37 @@ class _ModelUpdateGraph(object):
         Returns:
             A list of (gradient, variable) pairs.
         """
-        # Create a dictionary mapping each variable name to a list of
-        # (gradient, variable) pairs (one pair from each sub-batch).
-        d = {}
-        for grad_vars in all_grad_vars:
-            for g, v in grad_vars:
-                if v.name not in d:
-                    d[v.name] = []
-                d[v.name].append((g, v))
+        # Group the (gradient, variable) pairs by variable. The optimizer
+        # returns the pairs in the same (trainable-variable) order for every
+        # sub-batch, so the grouping is positional.
+        grouped = list(zip(*all_grad_vars))
 
         # For each variable, sum the gradients from all sub-batches and store
-        # the result in avg_grad_vars.
+        # the result in avg_grad_vars. If the user specified a reduction
+        # device then the sums are placed there, so that the all-to-one
+        # traffic from the replicas goes over a single, predictable link
+        # instead of whichever device TensorFlow happens to pick.
         avg_grad_vars = []
-        for var_name, gv_list in list(d.items()):
-            var = gv_list[0][1]
-            found_none_value = False
-            for g, v in gv_list:
-                if g is None:
-                    found_none_value = True
-                    break
-            if found_none_value:
-                avg_grad_vars.append((None, var))
-            else:
-                weighted_grads = []
-                for i, (g, v) in enumerate(gv_list):
-                    assert v == var
-                    expanded = tf.expand_dims(g * weights[i], 0)
-                    weighted_grads.append(expanded)
-                tmp = tf.concat(axis=0, values=weighted_grads)
-                avg_grad = tf.reduce_sum(input_tensor=tmp, axis=0)
+        with tf.compat.v1.device(self._config.reduction_device or None):
+            for gv_list in grouped:
+                var = gv_list[0][1]
+                # Almost every variable receives a gradient from every
+                # sub-batch, so collect the weighted gradients in a single
+                # pass and fall back to None only if any were missing.
+                weighted_grads = [g * weights[i]
+                                  for i, (g, v) in enumerate(gv_list)
+                                  if g is not None]
+                if len(weighted_grads) < len(gv_list):
+                    avg_grad = None
+                elif len(weighted_grads) == 1:
+                    # Single replica: nothing to sum.
+                    avg_grad = weighted_grads[0]
+                else:
+                    # accumulate_n sums the gradients into a single buffer
+                    # and, unlike add_n, doesn't need all of its inputs to
+                    # be materialized at the same time, which lowers peak
+                    # memory for large gradient tensors.
+                    avg_grad = tf.math.accumulate_n(weighted_grads)
                 avg_grad_vars.append((avg_grad, var))
 
         return avg_grad_vars